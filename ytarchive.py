@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
+import base64
+import concurrent.futures
 from enum import Enum
 import faulthandler
 import getopt
+import http.client
 import http.cookiejar
 import io
 import json
@@ -9,6 +12,7 @@ import logging
 import os
 import platform
 import queue
+import re
 import shlex
 import shutil
 import signal
@@ -38,21 +42,44 @@ ABOUT = {
 '''
 
 # Constants
-INFO_URL = "https://www.youtube.com/get_video_info?video_id={0}&el=detailpage"
-HTML_VIDEO_LINK_TAG = '<link rel="canonical" href="https://www.youtube.com/watch?v='
+PLAYER_URL = "https://www.youtube.com/youtubei/v1/player?prettyPrint=false"
+PLAYER_CLIENT_NAME = "WEB"
+PLAYER_CLIENT_VERSION = "2.20240101.00.00"
+HTML_VIDEO_LINK_RE = re.compile(r'<link rel="canonical" href="https://www\.youtube\.com/watch\?v=([\w-]+)"')
 PLAYABLE_OK = "OK"
 PLAYABLE_OFFLINE = "LIVE_STREAM_OFFLINE"
 PLAYABLE_UNPLAYABLE = "UNPLAYABLE"
 PLAYABLE_ERROR = "ERROR"
 BAD_CHARS = '<>:"/\\|?*'
+BAD_CHARS_TRANS = str.maketrans({c: "_" for c in BAD_CHARS})
 DTYPE_AUDIO = "audio"
 DTYPE_VIDEO = "video"
 DEFAULT_VIDEO_QUALITY = "best"
 RECHECK_TIME = 15
 FRAG_MAX_TRIES = 10
 HOUR = 60 * 60
+PROGRESS_INTERVAL = 0.5
 BUF_SIZE = 8192
+COPY_BUF_SIZE = 64 * 1024
+WRITE_BATCH_SIZE = 8 * 1024 * 1024
+PREFETCH_FRAGS_PER_THREAD = 4  # Fragments allowed to wait on an earlier one, per thread
+WRITE_BATCH_FRAGS = 64  # Two buffers per fragment, stays well under IOV_MAX
+MAX_REDIRECTS = 10
+USER_AGENT = "Python-urllib/{0}.{1}".format(*sys.version_info[:2])
 WINDOWS = sys.platform in ["win32", "msys"]
+# Our audio and video files are fragmented MP4, or WebM for VP9 video. Both
+# describe their streams up front in the header, so there is nothing for
+# ffmpeg to gain by probing and analyzing them before copying.
+# ffmpeg 6 and up also mux our files many times slower unless they are read
+# as non-seekable with a bigger packet queue per input
+FFMPEG_INPUT_ARGS = [
+    "-probesize", "32",
+    "-analyzeduration", "0",
+    "-seekable", "0",
+    "-thread_queue_size", "1024"
+]
+# sendfile only supports regular files as the destination on Linux
+USE_SENDFILE = sys.platform.startswith("linux") and hasattr(os, "sendfile")
 
 # https://gist.github.com/AgentOak/34d47c65b1d28829bb17c24c04a0096f
 AUDIO_ITAG = 140
@@ -67,6 +94,7 @@ VIDEO_LABEL_ITAGS = {
     "1080p": {"h264": 137, "vp9": 248},
     "1080p60": {"h264": 299, "vp9": 303},
 }
+VIDEO_LABEL_PRIORITY = {label: i for i, label in enumerate(VIDEO_LABEL_ITAGS)}
 
 
 class Action(Enum):
@@ -78,13 +106,14 @@ class Action(Enum):
 # Simple class to more easily keep track of what fields are available for
 # file name formatting
 class FormatInfo:
-    finfo = {
-        "id": "",
-        "title": "",
-        "channel_id": "",
-        "channel": "",
-        "upload_date": ""
-    }
+    def __init__(self):
+        self.finfo = {
+            "id": "",
+            "title": "",
+            "channel_id": "",
+            "channel": "",
+            "upload_date": ""
+        }
 
     def set_info(self, player_response):
         pmfr = player_response["microformat"]["playerMicroformatRenderer"]
@@ -102,29 +131,45 @@ class FormatInfo:
 
 # Info to be sent through the progress queue
 class ProgressInfo:
-    def __init__(self, dtype, byte_count, max_seq):
+    __slots__ = ("data_type", "bytes", "frags", "max_seq")
+
+    def __init__(self, dtype, byte_count, frag_count, max_seq):
         self.data_type = dtype
         self.bytes = byte_count
+        self.frags = frag_count
         self.max_seq = max_seq
 
 
 # Fragment information/data
 class Fragment:
-    def __init__(self, seq, header_seqnum, fname, data):
+    __slots__ = ("seq", "fname", "x_head_seqnum", "data", "size", "written")
+
+    def __init__(self, seq, header_seqnum, fname, data, size):
         self.seq = seq
         self.fname = fname
         self.x_head_seqnum = header_seqnum
         self.data = data
+        self.size = size
+        self.written = 0  # Bytes of this fragment already in the stream file
+
+
+# Raised when a write fails after some of the data already reached the file
+class PartialWriteError(Exception):
+    def __init__(self, written, err):
+        super().__init__(err)
+        self.written = written
+        self.err = err
 
 
 # Metadata for the final file
 class MetaInfo:
-    meta = {
-        "title": "",
-        "artist": "",
-        "date": "",
-        "comment": ""
-    }
+    def __init__(self):
+        self.meta = {
+            "title": "",
+            "artist": "",
+            "date": "",
+            "comment": ""
+        }
 
 
     def set_meta(self, player_response):
@@ -158,7 +203,8 @@ class DownloadInfo:
         self.format_info = FormatInfo()
         self.metadata = MetaInfo()
 
-        self.stopping = False
+        # Set when the download should stop. An Event so threads can check it without the lock
+        self.stop_event = threading.Event()
         self.in_progress = False
         self.is_live = False
         self.vp9 = False
@@ -176,7 +222,10 @@ class DownloadInfo:
         self.quality = -1
         self.retry_secs = 0
         self.thread_count = 1
-        self.last_updated = 0
+        # time.monotonic() values, they're only used to measure intervals.
+        # Start far in the past so the first check always goes through
+        self.last_updated = float("-inf")
+        self.last_checked = float("-inf")
         self.target_duration = 5
         self.expires_in_seconds = 21540  # Usual 5h 59m expiration
 
@@ -211,11 +260,23 @@ def logwarn(msg):
     logging.warning("\033[33m{0}\033[0m\033[K".format(msg))
 
 
-def loginfo(msg):
+def loginfo(msg, *args):
+    # Info messages are off unless verbose, same as debug ones
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+
+    if args:
+        msg = msg.format(*args)
     logging.info("\033[32m{0}\033[0m\033[K".format(msg))
 
 
-def logdebug(msg):
+def logdebug(msg, *args):
+    # Debug messages are usually off, don't format them for nothing
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+
+    if args:
+        msg = msg.format(*args)
     logging.debug("\033[36m{0}\033[0m\033[K".format(msg))
 
 
@@ -301,7 +362,7 @@ class DoOrDie(object):
             timeout, fun, args, kwargs, ret_q = task
 
             self.active_task = task
-            self.deadline = time.time() + timeout
+            self.deadline = time.monotonic() + timeout
             try:
                 ret = self._exec(fun, args, kwargs)
                 ret_q.put([True, ret])
@@ -322,7 +383,7 @@ class DoOrDie(object):
             if not self.deadline:
                 continue
 
-            if time.time() >= self.deadline:
+            if time.monotonic() >= self.deadline:
                 logerror("dod-time: {!r}".format(self.active_task[:-1]))
                 self._dump()
                 sys.exit(1)
@@ -338,7 +399,7 @@ class DoOrDie(object):
                 sys.platform,
                 platform.python_compiler(),
                 platform.version(),
-                time.time(),
+                time.monotonic(),
                 self.deadline,
                 repr(self.active_task)
             ]]) + "\n\n")
@@ -358,10 +419,7 @@ def sterilize_filename(fname):
 
     :param fname:
     """
-    for c in BAD_CHARS:
-        fname = fname.replace(c, "_")
-
-    return fname
+    return fname.translate(BAD_CHARS_TRANS)
 
 
 def format_size(bsize):
@@ -370,12 +428,94 @@ def format_size(bsize):
     :param bsize:
     """
     postfixes = ["bytes", "KiB", "MiB", "GiB"]  # don't even bother with terabytes
-    i = 0
-    while bsize > 1024:
-        bsize = bsize / 1024
-        i += 1
+    # Every 10 bits is another factor of 1024
+    i = min(max(int(bsize).bit_length() - 1, 0) // 10, len(postfixes) - 1)
 
-    return "{0:.2f}{1}".format(bsize, postfixes[i])
+    return "{0:.2f}{1}".format(bsize / (1 << (10 * i)), postfixes[i])
+
+
+def write_buffers(f, bufs):
+    """
+    Write all of the given buffers to the unbuffered file f
+    Uses a single writev call where available, looping on partial writes
+    Returns the number of bytes written. Raises PartialWriteError with the
+    number of bytes that made it to the file if writing fails part way
+
+    :param f:
+    :param bufs:
+    """
+    bufs = [memoryview(b) for b in bufs if len(b) > 0]
+    total = 0
+
+    try:
+        while len(bufs) > 0:
+            if hasattr(os, "writev"):
+                written = os.writev(f.fileno(), bufs)
+            else:
+                written = f.write(bufs[0])
+
+            total += written
+            while written > 0:
+                if written >= len(bufs[0]):
+                    written -= len(bufs[0])
+                    bufs.pop(0)
+                else:
+                    bufs[0] = bufs[0][written:]
+                    written = 0
+    except OSError as err:
+        raise PartialWriteError(total, err) from err
+
+    return total
+
+
+def write_frag_file(f, fname, skip=0):
+    """
+    Append the fragment file fname to the unbuffered file f, minus any sidx atom
+    The bulk of the data is copied with sendfile where available so it never
+    has to pass through Python
+    Returns the number of bytes written. Raises PartialWriteError with the
+    number of bytes that made it to the file if writing fails part way
+
+    :param f:
+    :param fname:
+    :param skip: Bytes of the fragment already written by an earlier attempt
+    """
+    written = 0
+
+    with open(fname, "rb", buffering=0) as rf:
+        # Remvoe sidx atoms from video and audio
+        # Fixes an issue with streams encoded differently than normal
+        head = remove_sidx(rf.read(BUF_SIZE))
+        ofs = rf.tell() + max(skip - len(head), 0)
+
+        try:
+            written += write_buffers(f, [memoryview(head)[skip:]])
+
+            if USE_SENDFILE:
+                remaining = os.fstat(rf.fileno()).st_size - ofs
+
+                while remaining > 0:
+                    sent = os.sendfile(f.fileno(), rf.fileno(), ofs, remaining)
+                    if sent == 0:
+                        break
+
+                    ofs += sent
+                    remaining -= sent
+                    written += sent
+            else:
+                rf.seek(ofs)
+                while True:
+                    buf = rf.read(COPY_BUF_SIZE)
+                    if len(buf) == 0:
+                        break
+
+                    written += write_buffers(f, [buf])
+        except PartialWriteError as err:
+            raise PartialWriteError(written + err.written, err.err) from err.err
+        except OSError as err:
+            raise PartialWriteError(written, err) from err
+
+    return written
 
 
 def execute(args):
@@ -386,10 +526,12 @@ def execute(args):
     :param args:
     """
     retcode = 0
-    logdebug("Executing command: {0}".format(" ".join(shlex.quote(x) for x in args)))
+    logdebug("Executing command: {0}", " ".join(shlex.quote(x) for x in args))
 
     try:
-        retcode = subprocess.run(args, capture_output=True, check=True, encoding="utf-8").returncode
+        # Only stderr is ever looked at, don't bother piping stdout
+        retcode = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+                                 encoding="utf-8").returncode
     except subprocess.CalledProcessError as err:
         retcode = err.returncode
         logerror(err.stderr)
@@ -414,31 +556,180 @@ def patch_getaddrinfo(inet_family):
     socket.getaddrinfo = new_getaddrinfo
 
 
+# Keep-alive HTTP client for requests made over and over to the same host.
+# urlopen makes a new connection, and a new TLS handshake, for every request.
+# Not thread safe, each thread should use its own.
+class HTTPClient:
+    def __init__(self, cookie_jar=None):
+        self.conns = {}
+        self.cookie_jar = cookie_jar
+
+    def open(self, url, timeout, data=None, extra_headers=None):
+        """
+        GET the given URL and return the response, following redirects
+        POSTs instead if data is given
+        Raises urllib.error.HTTPError on error statuses like urlopen does
+
+        :param url:
+        :param timeout:
+        :param data:
+        :param extra_headers:
+        """
+        for _ in range(MAX_REDIRECTS):
+            headers = {"User-Agent": USER_AGENT}
+            if data is not None and extra_headers:
+                headers.update(extra_headers)
+
+            req = urllib.request.Request(url)
+            if self.cookie_jar is not None:
+                self.cookie_jar.add_cookie_header(req)
+                headers.update(req.unredirected_hdrs)
+
+            resp = self._request(url, headers, timeout, data)
+            if self.cookie_jar is not None:
+                self.cookie_jar.extract_cookies(resp, req)
+
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader("Location"):
+                resp.read()
+                url = urllib.parse.urljoin(url, resp.getheader("Location"))
+
+                # Only 307 and 308 keep the method and body
+                if resp.status not in (307, 308):
+                    data = None
+                continue
+
+            if resp.status >= 400:
+                # Read the body so the connection can be used again
+                body = resp.read()
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(body))
+
+            return resp
+
+        raise urllib.error.URLError("Too many redirects")
+
+    def close(self):
+        for conn in self.conns.values():
+            conn.close()
+
+        self.conns.clear()
+
+    def _request(self, url, headers, timeout, data=None):
+        parsedurl = urllib.parse.urlsplit(url)
+        key = (parsedurl.scheme, parsedurl.netloc)
+        path = parsedurl.path or "/"
+        if parsedurl.query:
+            path += "?" + parsedurl.query
+
+        conn = self.conns.get(key)
+        reused = conn is not None
+
+        while True:
+            if not conn:
+                conn = self._connect(parsedurl.scheme, parsedurl.netloc, timeout)
+                self.conns[key] = conn
+
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+
+            try:
+                # Requests to a plain http proxy need the full URL
+                method = "GET" if data is None else "POST"
+                if conn.full_url:
+                    conn.request(method, url, body=data, headers=dict(headers, **conn.proxy_headers))
+                else:
+                    conn.request(method, path, body=data, headers=headers)
+                return conn.getresponse()
+            except ConnectionError:
+                conn.close()
+                del self.conns[key]
+                conn = None
+
+                # The server probably closed our idle connection. Try again with a new one
+                if reused:
+                    reused = False
+                    continue
+
+                raise
+            except Exception:
+                conn.close()
+                del self.conns[key]
+                raise
+
+    def _connect(self, scheme, netloc, timeout):
+        conn_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        proxy = urllib.request.getproxies().get(scheme)
+        full_url = False
+        proxy_headers = {}
+
+        if proxy and not urllib.request.proxy_bypass(netloc):
+            if "://" not in proxy:
+                proxy = "http://" + proxy
+
+            parsedproxy = urllib.parse.urlsplit(proxy)
+            if parsedproxy.username is not None:
+                # Log in to the proxy like urlopen's ProxyHandler would
+                creds = "{0}:{1}".format(urllib.parse.unquote(parsedproxy.username),
+                                         urllib.parse.unquote(parsedproxy.password or ""))
+                proxy_headers["Proxy-Authorization"] = "Basic " + base64.b64encode(creds.encode()).decode("ascii")
+
+            conn = conn_class(parsedproxy.hostname, parsedproxy.port, timeout=timeout)
+            if scheme == "https":
+                conn.set_tunnel(netloc, headers=proxy_headers)
+            else:
+                full_url = True
+        else:
+            conn = conn_class(netloc, timeout=timeout)
+
+        conn.full_url = full_url
+        conn.proxy_headers = proxy_headers
+        return conn
+
+
+# Shared client for youtube page, DASH manifest and thumbnail requests
+HTTP_CLIENT = HTTPClient()
+HTTP_CLIENT_LOCK = threading.Lock()
+
+
+def download_bytes(url, post_data=None, headers=None):
+    """
+    Download data from the given URL and return it as bytes
+    :param url:
+    :param post_data: Sent as a POST request body if given
+    :param headers: Extra headers for a POST request
+    """
+    with HTTP_CLIENT_LOCK:
+        try:
+            with HTTP_CLIENT.open(url, 5, post_data, headers) as resp:
+                return resp.read()
+        except Exception as err:
+            HTTP_CLIENT.close()
+            logwarn("Failed to retrieve data from {0}: {1}".format(url, err))
+            return None
+
+
 def download_as_text(url):
     """
     Download data from the given URL and return it as unicode text
     :param url:
     """
-    data = b""
-
-    try:
-        with urllib.request.urlopen(url, timeout=5) as resp:
-            data = resp.read()
-    except Exception as err:
-        logwarn("Failed to retrieve data from {0}: {1}".format(url, err))
+    data = download_bytes(url)
+    if data is None:
         return None
 
     return data.decode("utf-8")
 
 
 def download_thumbnail(url, fname):
-    try:
-        with urllib.request.urlopen(url, timeout=5) as resp:
-            with open(fname, "wb") as f:
-                f.write(resp.read())
-    except Exception as err:
-        logwarn("Failed to download thumbnail: {0}".format(err))
-        return False
+    with HTTP_CLIENT_LOCK:
+        try:
+            with HTTP_CLIENT.open(url, 5) as resp:
+                with open(fname, "wb") as f:
+                    shutil.copyfileobj(resp, f, COPY_BUF_SIZE)
+        except Exception as err:
+            HTTP_CLIENT.close()
+            logwarn("Failed to download thumbnail: {0}".format(err))
+            return False
 
     return True
 
@@ -449,16 +740,26 @@ def get_player_response(info):
 
     :param info:
     """
-    vinfo = download_as_text(INFO_URL.format(info.vid))
+    payload = {
+        "context": {
+            "client": {
+                "clientName": PLAYER_CLIENT_NAME,
+                "clientVersion": PLAYER_CLIENT_VERSION
+            }
+        },
+        "videoId": info.vid
+    }
+
+    # The player endpoint returns the player response itself as JSON
+    # json.loads takes the raw bytes just fine, no need to decode them first
+    vinfo = download_bytes(PLAYER_URL, json.dumps(payload).encode("utf-8"),
+                           {"Content-Type": "application/json"})
 
     if not vinfo or len(vinfo) == 0:
         logwarn("No video information found, somehow")
         return None
 
-    parsedinfo = urllib.parse.parse_qs(vinfo)
-    player_response = json.loads(parsedinfo["player_response"][0])
-
-    return player_response
+    return json.loads(vinfo)
 
 
 def make_quality_list(formats):
@@ -467,14 +768,7 @@ def make_quality_list(formats):
 
     :param formats:
     """
-    qualities = ""
-    quarity = ""
-
-    for f in formats:
-        qualities += f + ", "
-
-    qualities += "best"
-    return qualities
+    return ", ".join(list(formats) + ["best"])
 
 
 def parse_quality_list(formats, quality):
@@ -570,7 +864,7 @@ def get_playable_player_response(info):
     selected_qualities = []
 
     if info.selected_quality:
-        selected_qualities = parse_quality_list(list(VIDEO_LABEL_ITAGS.keys()), info.selected_quality)
+        selected_qualities = parse_quality_list(VIDEO_LABEL_ITAGS, info.selected_quality)
 
     while retry:
         player_response = get_player_response(info)
@@ -623,9 +917,12 @@ def get_playable_player_response(info):
         elif playability_status == PLAYABLE_OFFLINE:
             # We've already started downloading, stream might be experiencing issues
             if info.in_progress:
-                logdebug("Livestream status is {0} mid-download".format(PLAYABLE_OFFLINE))
+                logdebug("Livestream status is {0} mid-download", PLAYABLE_OFFLINE)
                 return None
 
+            # Jesus fuck youtube, embed some more objects why don't you
+            stream_renderer = playability.get("liveStreamability", {}).get("liveStreamabilityRenderer", {})
+
             if info.wait == Action.DO_NOT:
                 print("Stream appears to be a future scheduled stream, and you opted not to wait.")
                 return None
@@ -637,13 +934,12 @@ def get_playable_player_response(info):
             if first_wait:
                 print()
                 if len(selected_qualities) < 1:
-                    selected_qualities = get_quality_from_user(list(VIDEO_LABEL_ITAGS.keys()), True)
+                    selected_qualities = get_quality_from_user(VIDEO_LABEL_ITAGS, True)
 
             if info.retry_secs > 0:
                 if first_wait:
                     try:
-                        poll_delay_ms = playability["liveStreamability"]["liveStreamabilityRenderer"]["pollDelayMs"]
-                        poll_delay = int(int(poll_delay_ms) / 1000)
+                        poll_delay = int(int(stream_renderer["pollDelayMs"]) / 1000)
 
                         if info.retry_secs < poll_delay:
                             info.retry_secs = poll_delay
@@ -656,11 +952,9 @@ def get_playable_player_response(info):
                 time.sleep(info.retry_secs)
                 continue
 
-            # Jesus fuck youtube, embed some more objects why don't you
-            sched_time = int(playability["liveStreamability"]["liveStreamabilityRenderer"]["offlineSlate"][
-                                 "liveStreamOfflineSlateRenderer"]["scheduledStartTime"])
-            cur_time = int(time.time())
-            slep_time = sched_time - cur_time
+            sched_time = int(
+                stream_renderer["offlineSlate"]["liveStreamOfflineSlateRenderer"]["scheduledStartTime"])
+            slep_time = sched_time - time.time()
 
             if slep_time > 0:
                 if not first_wait:
@@ -671,17 +965,17 @@ def get_playable_player_response(info):
                 first_wait = False
                 secs_late = 0
 
-                print("Stream starts in {0} seconds. Waiting for this time to elapse...".format(slep_time))
+                print("Stream starts in {0} seconds. Waiting for this time to elapse...".format(int(slep_time)))
 
                 # Loop it just in case a rogue sleep interrupt happens
+                # Keep the fractional seconds, truncating them had us sleeping
+                # up to a second past the scheduled time
                 while slep_time > 0:
-                    # There must be a better way but whatever
                     time.sleep(slep_time)
-                    cur_time = int(time.time())
-                    slep_time = sched_time - cur_time
+                    slep_time = sched_time - time.time()
 
                     if slep_time > 0:
-                        logdebug("Woke up {0} seconds early. Continuing sleep...".format(slep_time))
+                        logdebug("Woke up {0:.1f} seconds early. Continuing sleep...", slep_time)
 
                 # We've waited until the scheduled time
                 continue
@@ -692,8 +986,9 @@ def get_playable_player_response(info):
 
             # If we get this far, the stream's scheduled time has passed but it's still not started
             # Check every 15 seconds
+            # Count from the scheduled time, the player response requests take time too
             time.sleep(RECHECK_TIME)
-            secs_late += RECHECK_TIME
+            secs_late = int(time.time() - sched_time)
             print("\rStream is {0} seconds late...".format(secs_late), end="")
             continue
 
@@ -736,7 +1031,7 @@ def get_urls_from_manifest(manifest):
 
         for r in reps:
             itag = r.get("id")
-            url = r.find("{*}BaseURL").text + "sq/{0}"
+            url = r.find("{*}BaseURL").text + "sq/"
 
             try:
                 int(itag)
@@ -762,7 +1057,8 @@ def get_download_urls(info, formats):
     urls = {}
 
     if info.dash_manifest_url:
-        manifest = download_as_text(info.dash_manifest_url)
+        # The XML parser takes the raw bytes and handles the encoding itself
+        manifest = download_bytes(info.dash_manifest_url)
 
         if manifest:
             urls = get_urls_from_manifest(manifest)
@@ -772,7 +1068,7 @@ def get_download_urls(info, formats):
 
     for fmt in formats:
         if "url" in fmt:
-            urls[fmt["itag"]] = fmt["url"] + "&sq={0}"
+            urls[fmt["itag"]] = fmt["url"] + "&sq="
 
     return urls
 
@@ -791,7 +1087,7 @@ def get_video_info(info):
             # Don't even bother to avoid complexity. Might change later.
             return False
 
-        if info.stopping:
+        if info.stop_event.is_set():
             return False
 
         # We already know there's no information to be gotten
@@ -799,11 +1095,14 @@ def get_video_info(info):
             return None
 
         # Almost nothing we care about is likely to change in 15 seconds,
-        # except maybe whether the livestream is online
-        update_delta = time.time() - info.last_updated
-        if update_delta < RECHECK_TIME:
+        # except maybe whether the livestream is online.
+        # Go by the last attempt rather than the last success, so threads
+        # that all run into the same problem don't each make their own request
+        check_delta = time.monotonic() - info.last_checked
+        if check_delta < RECHECK_TIME:
             return False
 
+        info.last_checked = time.monotonic()
         vals = get_playable_player_response(info)
         if not vals:
             return False
@@ -812,6 +1111,7 @@ def get_video_info(info):
         selected_qualities = vals["selected_qualities"]
         video_details = player_response["videoDetails"]
         streaming_data = player_response["streamingData"]
+        formats = streaming_data["adaptiveFormats"]
         pmfr = player_response["microformat"]["playerMicroformatRenderer"]
         live_details = pmfr["liveBroadcastDetails"]
         is_live = live_details["isLiveNow"]
@@ -822,11 +1122,11 @@ def get_video_info(info):
             # If not then download it. Else youtube-dl is a better choice.
             if "endTimestamp" in live_details:
                 # Assume that all formats will be fully processed if one is, and vice versa
-                if not "url" in streaming_data["adaptiveFormats"][0]:
+                if not "url" in formats[0]:
                     print("Livestream has ended and is being processed. Download URLs are not available.")
                     return False
 
-                url = streaming_data["adaptiveFormats"][0]["url"]
+                url = formats[0]["url"]
                 if not is_fragmented(url):
                     print("Livestream has been processed, use youtube-dl instead.")
                     return False
@@ -838,31 +1138,22 @@ def get_video_info(info):
         if "dashManifestUrl" in streaming_data:  # Should be but maybe it isn't sometimes
             info.dash_manifest_url = streaming_data["dashManifestUrl"]
 
-        formats = streaming_data["adaptiveFormats"]
         info.target_duration = formats[0]["targetDurationSec"]
         dl_urls = get_download_urls(info, formats)
 
         if info.quality < 0:
-            qualities = ["audio_only"]
-            itags = list(VIDEO_LABEL_ITAGS.keys())
             found = False
 
-            # Generate a list of available qualities, sorted in order from best to worst
+            # Generate a list of available qualities, sorted in order from worst to best
             # Assuming if VP9 is available, h264 should be available for that quality too
+            labels = set()
             for fmt in formats:
                 if fmt["mimeType"].startswith("video/mp4"):
                     qlabel = fmt["qualityLabel"].lower()
-                    priority = itags.index(qlabel)
-                    idx = 0
-
-                    for q in qualities:
-                        p = itags.index(q)
-                        if p > priority:
-                            break
-
-                        idx += 1
+                    if qlabel in VIDEO_LABEL_PRIORITY:
+                        labels.add(qlabel)
 
-                    qualities.insert(idx, qlabel)
+            qualities = ["audio_only"] + sorted(labels, key=VIDEO_LABEL_PRIORITY.get)
 
             while not found:
                 if len(selected_qualities) == 0:
@@ -874,7 +1165,7 @@ def get_video_info(info):
                     # Get the best quality of those availble.
                     # This is why we sorted the list as we made it.
                     if q == "best":
-                        q = qualities[len(qualities) - 1]
+                        q = qualities[-1]
 
                     video_itag = VIDEO_LABEL_ITAGS[q]
                     aonly = video_itag == VIDEO_LABEL_ITAGS["audio_only"]
@@ -927,7 +1218,7 @@ def get_video_info(info):
 
         info.expires_in_seconds = int(streaming_data["expiresInSeconds"])
         info.is_live = is_live
-        info.last_updated = time.time()
+        info.last_updated = time.monotonic()
 
     return True
 
@@ -979,7 +1270,7 @@ def remove_sidx(data):
     return new_data
 
 
-def download_frags(data_type, info, seq_queue, data_queue, frag_files):
+def download_frags(data_type, info, seq_queue, data_queue, frag_files, tname):
     """
     Download a fragment and send it back via data_queue
 
@@ -988,17 +1279,17 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
     :param seq_queue:
     :param data_queue:
     :param frag_files:
+    :param tname: Name to log as, since pool threads are shared
     """
     downloading = True
     frag_tries = 0
     url = info.mdl_info[data_type].download_url
-    tname = threading.current_thread().getName()
+    client = HTTPClient()
 
     while downloading:
         # Check if the user decided to cancel this download, and exit gracefully
-        with info.lock:
-            if info.stopping:
-                break
+        if info.stop_event.is_set():
+            break
 
         tries = 0
         full_retries = 3
@@ -1011,10 +1302,9 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
             frag_tries = 0
         except queue.Empty:
             # Check again in case the user opted to stop
-            with info.lock:
-                if info.stopping:
-                    downloading = False
-                    break
+            if info.stop_event.is_set():
+                downloading = False
+                break
 
             frag_tries += 1
             if frag_tries >= FRAG_MAX_TRIES:
@@ -1027,8 +1317,8 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
                 with info.lock:
                     if info.mdl_info[data_type].active_threads > 1:
                         logdebug(
-                            "{0}: Starved for fragment numbers and multiple fragment threads running".format(tname))
-                        logdebug("{0}: Closing this thread to minimize unneeded network requests".format(tname))
+                            "{0}: Starved for fragment numbers and multiple fragment threads running", tname)
+                        logdebug("{0}: Closing this thread to minimize unneeded network requests", tname)
                         info.print_status()
 
                         downloading = False
@@ -1038,13 +1328,13 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
                         get_video_info(info)
 
                     if not info.is_live:
-                        logdebug("{0}: Starved for fragment numbers and stream is offline".format(tname))
+                        logdebug("{0}: Starved for fragment numbers and stream is offline", tname)
                         downloading = False
                     else:
                         logdebug(
-                            "{0}: Could not get a new fragment to download after {1} tries and we are the only active downloader".format(
-                                tname, FRAG_MAX_TRIES))
-                        logdebug("{0}: That is an issue, hopefully it will correct itself".format(tname))
+                            "{0}: Could not get a new fragment to download after {1} tries and we are the only active downloader",
+                            tname, FRAG_MAX_TRIES)
+                        logdebug("{0}: That is an issue, hopefully it will correct itself", tname)
                         info.print_status()
                         frag_tries = 0
 
@@ -1053,17 +1343,16 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
         if max_seq > -1:
             with info.lock:
                 if not info.is_live and seq >= max_seq:
-                    logdebug("{0}: Stream is finished and highest sequence reached".format(tname))
+                    logdebug("{0}: Stream is finished and highest sequence reached", tname)
                     downloading = False
                     break
 
         fname = "{0}.frag{1}.ts".format(info.mdl_info[data_type].base_fpath, seq)
 
         while tries < FRAG_MAX_TRIES:
-            with info.lock:
-                if info.stopping:
-                    downloading = False
-                    break
+            if info.stop_event.is_set():
+                downloading = False
+                break
 
             bytes_written = 0
 
@@ -1071,25 +1360,23 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
                 header_seqnum = -1
                 data = io.BytesIO()
 
-                with urllib.request.urlopen(url.format(seq), timeout=info.target_duration * 2) as resp:
+                with client.open(url + str(seq), info.target_duration * 2) as resp:
                     header_seqnum = int(resp.getheader("X-Head-Seqnum", -1))
 
                     if frag_files:
                         with open(fname, "wb") as frag_file:
-                            # Read response data into a file in BUF_SIZE chunks
-                            while True:
-                                buf = resp.read(BUF_SIZE)
-                                if len(buf) == 0:
-                                    break
-
-                                bytes_written += frag_file.write(buf)
+                            # Stream the response straight into the file
+                            shutil.copyfileobj(resp, frag_file, COPY_BUF_SIZE)
+                            bytes_written = frag_file.tell()
+                    elif resp.length is not None:
+                        # With a known length, read() allocates the buffer once at its
+                        # final size, and BytesIO shares it instead of copying
+                        buf = resp.read()
+                        data = io.BytesIO(buf)
+                        bytes_written = len(buf)
                     else:
-                        while True:
-                            buf = resp.read(BUF_SIZE)
-                            if len(buf) == 0:
-                                break
-
-                            bytes_written += data.write(buf)
+                        shutil.copyfileobj(resp, data, COPY_BUF_SIZE)
+                        bytes_written = data.tell()
 
                 # The request was a success but no data was given
                 # Increment the try counter and wait
@@ -1099,12 +1386,13 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
                         time.sleep(info.target_duration)
                         continue
                 else:
-                    data_queue.put(Fragment(seq, header_seqnum, fname, data))
+                    data_queue.put(Fragment(seq, header_seqnum, fname, data, bytes_written))
                     is_403 = False
                     break
             except urllib.error.HTTPError as err:
-                logdebug("{0}: HTTP Error for fragment {1}: {2}".format(tname, seq, err))
+                logdebug("{0}: HTTP Error for fragment {1}: {2}", tname, seq, err)
                 info.print_status()
+                url_refreshed = False
 
                 # 403 means our URLs have likely expired
                 if err.code == 403:
@@ -1113,8 +1401,9 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
                     is_403 = True
 
                     if not info.gvideo_ddl:  # Don't bother if gvideo links were the input
-                        logdebug("{0}: Attempting to retrieve a new download URL".format(tname))
+                        logdebug("{0}: Attempting to retrieve a new download URL", tname)
                         info.print_status()
+                        old_url = url
                         with info.lock:
                             new_url = info.mdl_info[data_type].download_url
 
@@ -1122,30 +1411,37 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
                                 url = new_url
                             elif get_video_info(info):
                                 url = info.mdl_info[data_type].download_url
+
+                        # Usually another thread already refreshed the URLs when they
+                        # all expire at once. No reason to wait before using the new one
+                        url_refreshed = url != old_url
                 elif err.code == 404:
                     if max_seq > -1:
                         with info.lock:
                             if not info.is_live and seq >= (max_seq - 2):
                                 logdebug(
-                                    "{0}: Stream has ended and fragment within the last two not found, probably not actually created".format(
-                                        tname))
+                                    "{0}: Stream has ended and fragment within the last two not found, probably not actually created",
+                                    tname)
                                 info.print_status()
                                 downloading = False
                                 break
 
                 tries += 1
-                if tries < FRAG_MAX_TRIES:
+                if tries < FRAG_MAX_TRIES and not url_refreshed:
                     time.sleep(info.target_duration)
             except Exception as err:
-                logdebug("{0}: Error with fragment {1}: {2}".format(tname, seq, err))
+                logdebug("{0}: Error with fragment {1}: {2}", tname, seq, err)
                 info.print_status()
 
+                # The connection may have been left mid-response. Start fresh
+                client.close()
+
                 if max_seq > -1:
                     with info.lock:
                         if not info.is_live and seq >= (max_seq - 2):
                             logdebug(
-                                "{0}: Stream has ended and fragment number is within two of the known max, probably not actually created".format(
-                                    tname))
+                                "{0}: Stream has ended and fragment number is within two of the known max, probably not actually created",
+                                tname)
                             downloading = False
                             try_delete(fname)
                             info.print_status()
@@ -1160,12 +1456,7 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
                 try_delete(fname)
                 info.print_status()
 
-                logdebug("{0}: Fragment {1}: {2}/{3} retries".format(
-                    tname,
-                    seq,
-                    tries,
-                    FRAG_MAX_TRIES
-                ))
+                logdebug("{0}: Fragment {1}: {2}/{3} retries", tname, seq, tries, FRAG_MAX_TRIES)
                 info.print_status()
 
                 with info.lock:
@@ -1180,36 +1471,39 @@ def download_frags(data_type, info, seq_queue, data_queue, frag_files):
                             info.print_status()
                             downloading = False
                         elif max_seq > -1 and seq < (max_seq - 2) and full_retries > 0:
-                            logdebug("{0}: More than two fragments away from the highest known fragment".format(tname))
-                            logdebug("{0}: Will try grabbing the fragment {1} more times".format(tname, full_retries))
+                            logdebug("{0}: More than two fragments away from the highest known fragment", tname)
+                            logdebug("{0}: Will try grabbing the fragment {1} more times", tname, full_retries)
                             info.print_status()
                         else:
                             downloading = False
                     else:
-                        logdebug("{0}: Fragment {1}: Stream still live, continuing download attempt".format(tname, seq))
+                        logdebug("{0}: Fragment {1}: Stream still live, continuing download attempt", tname, seq)
                         info.print_status()
                         tries = 0
 
-    logdebug("{0}: exiting".format(tname))
+    client.close()
+    logdebug("{0}: exiting", tname)
     info.print_status()
 
     with info.lock:
         info.mdl_info[data_type].active_threads -= 1
 
 
-def download_stream(data_type, dfile, progress_queue, info, frag_files):
+def download_stream(data_type, dfile, progress_queue, info, frag_files, pool):
     """
     Download the given data_type stream to dfile
     Sends progress info through progress_queue
+    Fragment downloaders are run in pool
 
     :param data_type:
     :param dfile:
     :param progress_queue:
     :param info:
     :param frag_files:
+    :param pool:
     """
-    data_queue = queue.Queue()
-    seq_queue = queue.Queue()
+    data_queue = queue.SimpleQueue()
+    seq_queue = queue.SimpleQueue()
     cur_frag = 0
     cur_seq = 0
     active_downloads = 0
@@ -1217,41 +1511,52 @@ def download_stream(data_type, dfile, progress_queue, info, frag_files):
     tries = 10
     tnum = 0
     stopping = False
-    dthreads = []
-    data = []
+    dfutures = []
+    pending = {}  # seq -> Fragment, waiting to be written in order
+    throttled = False  # Held back new downloads because too many were pending
+    progress_bytes = 0
+    progress_frags = 0
+    last_progress = time.monotonic()
     del_frags = []
-    f = open(dfile, "wb")
+    f = open(dfile, "wb", buffering=0)
 
     with info.lock:
         while info.mdl_info[data_type].active_threads < info.thread_count:
-            t = threading.Thread(target=download_frags,
-                                 args=(data_type, info, seq_queue, data_queue, frag_files),
-                                 name="{0}{1}".format(data_type, tnum))
-
-            dthreads.append(t)
             info.mdl_info[data_type].active_threads += 1
-            tnum += 1
             seq_queue.put((cur_seq, max_seqs))
             cur_seq += 1
             active_downloads += 1
-            t.start()
+            fut = pool.submit(download_frags, data_type, info, seq_queue, data_queue, frag_files,
+                              "{0}{1}".format(data_type, tnum))
+            # Wake the writer up when a downloader exits instead of waiting for the queue timeout
+            fut.add_done_callback(lambda _: data_queue.put(None))
+            dfutures.append(fut)
+            tnum += 1
 
     while True:
         downloading = False
+        stopping = info.stop_event.is_set()
 
-        with info.lock:
-            stopping = info.stopping
-
-        for t in dthreads:
-            if t.is_alive():
+        for fut in dfutures:
+            if not fut.done():
                 downloading = True
                 break
 
-        # Get all available data and start another download for each data retrieved
+        # Wait for data to become available, then get all available data
+        block = downloading
         while True:
             try:
-                d = data_queue.get_nowait()
-                data.append(d)
+                if block:
+                    d = data_queue.get(timeout=0.5)
+                    block = False
+                else:
+                    d = data_queue.get_nowait()
+
+                # A downloader exited, which the liveness check above will see next pass
+                if d is None:
+                    continue
+
+                pending[d.seq] = d
                 active_downloads -= 1
 
                 # We want to empty the queue so we don't leave any files behind
@@ -1260,31 +1565,16 @@ def download_stream(data_type, dfile, progress_queue, info, frag_files):
 
                 if d.x_head_seqnum > max_seqs:
                     max_seqs = d.x_head_seqnum
-
-                # If we know the current max sequence number, use that to
-                # determine if we try for another fragment. Else just try anyway
-                if max_seqs > 0:
-                    if cur_seq <= max_seqs + 1:
-                        # One higher than known max as we can download faster than
-                        # the fragments are made
-                        seq_queue.put((cur_seq, max_seqs))
-                        cur_seq += 1
-                        active_downloads += 1
-                else:
-                    seq_queue.put((cur_seq, max_seqs))
-                    cur_seq += 1
-                    active_downloads += 1
             except queue.Empty:
                 break
 
         if not downloading:
             break
 
-        # Wait for 100ms if no data is available
-        if len(data) == 0:
+        if len(pending) == 0:
             if not stopping and active_downloads <= 0:
-                logdebug("{0}-download: Somehow no active downloads and no data to write".format(data_type))
-                logdebug("{0}-download: Fragment this happened at: {1}".format(data_type, cur_frag))
+                logdebug("{0}-download: Somehow no active downloads and no data to write", data_type)
+                logdebug("{0}-download: Fragment this happened at: {1}", data_type, cur_frag)
                 info.print_status()
 
                 with info.lock:
@@ -1293,46 +1583,82 @@ def download_stream(data_type, dfile, progress_queue, info, frag_files):
                         cur_seq += 1
                         active_downloads += 1
 
-            time.sleep(0.1)
-            continue
-
-        # Write any fragments in the queue that are next for writing
-        i = 0
-        while i < len(data) and tries > 0:
-            d = data[i]
-            if not d.seq == cur_frag:
-                i += 1
-                continue
-
-            try:
-                bytes_written = 0
-                rf = None
-
-                if frag_files:
-                    rf = open(d.fname, "rb")
-                else:
-                    rf = d.data
-
-                with rf:
-                    # If we are using a BytesIO object, our pointer is probably
-                    # at the end. Seek to the beginning.
-                    rf.seek(0)
+        # Write any fragments that are next for writing
+        while cur_frag in pending and tries > 0:
+            # Gather every fragment that is ready in order, so they can all
+            # be written with a single call
+            batch = []
+            batch_size = 0
+            while (cur_frag + len(batch) in pending
+                   and len(batch) < WRITE_BATCH_FRAGS and batch_size < WRITE_BATCH_SIZE):
+                d = pending.pop(cur_frag + len(batch))
+                batch.append(d)
+                batch_size += d.size
+
+            # Bytes written for each fragment in the batch, and how many of
+            # them made it to the file completely
+            sizes = []
+            complete = 0
+            write_err = None
+
+            if frag_files:
+                # Fragment files are copied over without reading them into memory
+                for d in batch:
+                    try:
+                        sizes.append(write_frag_file(f, d.fname, d.written))
+                        complete += 1
+                    except PartialWriteError as err:
+                        sizes.append(err.written)
+                        write_err = err
+                        break
+                    except Exception as err:
+                        write_err = err
+                        break
+            else:
+                bufs = []
+                lens = []
+                for d in batch:
+                    buf = d.data.getvalue()
 
                     # Remvoe sidx atoms from video and audio
                     # Fixes an issue with streams encoded differently than normal
-                    buf = rf.read(BUF_SIZE)
-                    buf = remove_sidx(buf)
-                    bytes_written += f.write(buf)
+                    head = remove_sidx(buf[:BUF_SIZE])
+                    # Skip anything an earlier attempt already wrote
+                    tail = memoryview(buf)[BUF_SIZE + max(d.written - len(head), 0):]
+                    head = memoryview(head)[d.written:]
+                    bufs.extend((head, tail))
+                    lens.append(len(head) + len(tail))
+
+                written = 0
+                try:
+                    written = write_buffers(f, bufs)
+                except PartialWriteError as err:
+                    written = err.written
+                    write_err = err
+                except Exception as err:
+                    write_err = err
+
+                for size in lens:
+                    sizes.append(min(size, written))
+                    written -= sizes[-1]
+                    if sizes[-1] < size:
+                        break
 
-                    while True:
-                        buf = rf.read(BUF_SIZE)
-                        if len(buf) == 0:
-                            break
+                    complete += 1
+
+            for i, d in enumerate(batch):
+                size = sizes[i] if i < len(sizes) else 0
+                progress_bytes += size
 
-                        bytes_written += f.write(buf)
+                # Anything not written completely goes back to be tried again,
+                # picking up where it left off
+                if i >= complete:
+                    d.written += size
+                    pending[d.seq] = d
+                    continue
 
                 cur_frag += 1
-                progress_queue.put(ProgressInfo(data_type, bytes_written, max_seqs))
+                progress_frags += 1
 
                 if frag_files:
                     try:
@@ -1342,15 +1668,24 @@ def download_stream(data_type, dfile, progress_queue, info, frag_files):
                         logwarn("{0}-download: Will try again after the download has finished".format(data_type))
                         del_frags.append(d.fname)
                         info.print_status()
+                else:
+                    d.data.close()
 
-                data.remove(d)
+            # Only report progress every so often, there is no need to
+            # print a status line for every single fragment
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                progress_queue.put(ProgressInfo(data_type, progress_bytes, progress_frags, max_seqs))
+                progress_bytes = 0
+                progress_frags = 0
+                last_progress = time.monotonic()
+
+            if write_err is None:
                 tries = 10
-                i = 0  # Start from the beginning since the next one might have finished downloading earlier
-            except Exception as err:
+            else:
                 tries -= 1
                 logwarn(
                     "{0}-download: Error when attempting to write fragment {1} to {2}: {3}".format(data_type, cur_frag,
-                                                                                                   dfile, err))
+                                                                                                   dfile, write_err))
                 info.print_status()
 
                 if tries > 0:
@@ -1362,31 +1697,64 @@ def download_stream(data_type, dfile, progress_queue, info, frag_files):
 
             # Threads closing prematurely possibly due to disk writes taking too long
             # Open them back up
+            # Idle threads also close while we hold off on new downloads for a
+            # slow fragment, so replace them once that clears up
+            throttle_cleared = (throttled and len(pending) < info.thread_count * PREFETCH_FRAGS_PER_THREAD
+                                and (max_seqs <= 0 or cur_seq <= max_seqs + 1))
+            if throttle_cleared:
+                throttled = False
+
             with info.lock:
-                if (max_seqs - cur_seq) > 100 and info.mdl_info[data_type].active_threads < info.thread_count:
-                    logdebug(
-                        "{0}-download: More than 100 fragments below the current max and less than the max threads are running".format(
-                            data_type))
-                    logdebug("{0}-download: Starting more threads".format(data_type))
+                behind = (max_seqs - cur_seq) > 100
+                if (behind or throttle_cleared) and info.mdl_info[data_type].active_threads < info.thread_count:
+                    if behind:
+                        logdebug(
+                            "{0}-download: More than 100 fragments below the current max and less than the max threads are running",
+                            data_type)
+                    else:
+                        logdebug(
+                            "{0}-download: Caught up on waiting fragments and less than the max threads are running",
+                            data_type)
+                    logdebug("{0}-download: Starting more threads", data_type)
 
                     while info.mdl_info[data_type].active_threads < info.thread_count:
-                        t = threading.Thread(target=download_frags,
-                                             args=(data_type, info, seq_queue, data_queue, frag_files),
-                                             name="{0}{1}".format(data_type, tnum))
-
-                        dthreads.append(t)
                         info.mdl_info[data_type].active_threads += 1
-                        tnum += 1
                         seq_queue.put((cur_seq, max_seqs))
                         cur_seq += 1
                         active_downloads += 1
-                        t.start()
+                        fut = pool.submit(download_frags, data_type, info, seq_queue, data_queue, frag_files,
+                                          "{0}{1}".format(data_type, tnum))
+                        fut.add_done_callback(lambda _: data_queue.put(None))
+                        dfutures.append(fut)
+                        tnum += 1
+
+        # Start another download for each one that finished, all at once so they
+        # get the latest known max sequence number. Hold off while too many
+        # fragments are waiting on an earlier one, so memory use stays bounded
+        # when a single fragment is slow to arrive
+        if not stopping:
+            with info.lock:
+                active_threads = info.mdl_info[data_type].active_threads
+
+            # If we know the current max sequence number, use that to
+            # determine if we try for another fragment. Else just try anyway.
+            # One higher than known max as we can download faster than
+            # the fragments are made
+            while (active_downloads < active_threads
+                   and len(pending) < info.thread_count * PREFETCH_FRAGS_PER_THREAD
+                   and (max_seqs <= 0 or cur_seq <= max_seqs + 1)):
+                seq_queue.put((cur_seq, max_seqs))
+                cur_seq += 1
+                active_downloads += 1
+
+            if active_downloads < active_threads and len(pending) >= info.thread_count * PREFETCH_FRAGS_PER_THREAD:
+                throttled = True
 
         # Refresh the info every hour to keep our download URLs up to date
         # Might not actually be that helpful but will prevent last-second
         # expiration while still downloading a stream that was privated after ending
         with info.lock:
-            updated_secs = time.time() - info.last_updated
+            updated_secs = time.monotonic() - info.last_updated
             if not info.is_unavailable and updated_secs > HOUR:
                 get_video_info(info)
 
@@ -1394,27 +1762,28 @@ def download_stream(data_type, dfile, progress_queue, info, frag_files):
             logwarn("{0}-download: Stopping download, something must be wrong...".format(data_type))
             info.print_status()
 
-            with info.lock:
-                info.stopping = True
+            info.stop_event.set()
+            concurrent.futures.wait(dfutures)
 
-            for t in dthreads:
-                t.join()
+    if progress_frags > 0:
+        progress_queue.put(ProgressInfo(data_type, progress_bytes, progress_frags, max_seqs))
 
     if not f.closed:
         f.close()
 
     # Remove any files likely the result of an early termination
-    if len(data) > 0:
-        for d in data:
+    if len(pending) > 0:
+        for d in pending.values():
             try_delete(d.fname)
 
     # Attempt to remove any files that failed to be removed earlier
     if len(del_frags) > 0:
-        loginfo("{0}-download: Attempting to delete fragments that failed to be deleted before".format(data_type))
+        loginfo("{0}-download: Attempting to delete fragments that failed to be deleted before", data_type)
         for d in del_frags:
             try_delete(d)
 
-    logdebug("{0}-download thread closing".format(data_type))
+    log_future_errors(dfutures)
+    logdebug("{0}-download thread closing", data_type)
     info.print_status()
 
 
@@ -1444,7 +1813,7 @@ def parse_gvideo_url(url, dtype):
         print("Given video URL has the audio itag set. Make sure you set the correct URL(s)")
         return nurl
 
-    nurl = url[:sq_idx] + "&sq={0}"
+    nurl = url[:sq_idx] + "&sq="
     return nurl
 
 
@@ -1470,7 +1839,7 @@ def get_gvideo_url(info, dtype):
         # Lazy matching of URL to data type
         elif ((dtype == DTYPE_AUDIO and itag == AUDIO_ITAG)
               or (dtype == DTYPE_VIDEO and itag != AUDIO_ITAG)):
-            info.mdl_info[dtype].download_url = url[:sq_idx] + "&sq={0}"
+            info.mdl_info[dtype].download_url = url[:sq_idx] + "&sq="
             break
         else:
             print("URL given does not appear to be appropriate for the data type needed.")
@@ -1489,6 +1858,13 @@ def better_input(query: str) -> str:
     except KeyboardInterrupt:
         print("\nGood Bye~ ")
         exit(1)
+    except EOFError:
+        # Nobody to answer, e.g. running from a script or service with no stdin.
+        # Bail out instead of dying with a traceback
+        print()
+        logerror("Input was needed but stdin is closed.")
+        logerror("Pass the url, quality and --wait/--no-wait or --retry-stream options to run without prompts.")
+        exit(1)
 
 
 def parse_input_url(info):
@@ -1515,16 +1891,14 @@ def parse_input_url(info):
         elif lpath.startswith("/channel") and lpath.endswith("live"):
             # This is fucking awful but it works
             html = download_as_text(info.url)
-            if len(html) == 0:
+            if not html:
                 return
 
-            startidx = html.find(HTML_VIDEO_LINK_TAG)
-            if startidx < 0:
+            match = HTML_VIDEO_LINK_RE.search(html)
+            if not match:
                 return
 
-            startidx += len(HTML_VIDEO_LINK_TAG)
-            endidx = html.find('"', startidx)
-            info.vid = html[startidx:endidx]
+            info.vid = match.group(1)
     elif nl == "youtu.be":
         # path includes the leading slash
         info.vid = parsedurl.path.strip("/")
@@ -1543,13 +1917,13 @@ def parse_input_url(info):
 
         if itag == AUDIO_ITAG:
             if not info.mdl_info[DTYPE_AUDIO].download_url:
-                info.mdl_info[DTYPE_AUDIO].download_url = info.url[:sq_idx] + "&sq={0}"
+                info.mdl_info[DTYPE_AUDIO].download_url = info.url[:sq_idx] + "&sq="
 
             if not info.mdl_info[DTYPE_VIDEO].download_url and info.quality < 0:
                 get_gvideo_url(info, DTYPE_VIDEO)
         else:  # video url, presumably
             if not info.mdl_info[DTYPE_VIDEO].download_url:
-                info.mdl_info[DTYPE_VIDEO].download_url = info.url[:sq_idx] + "&sq={0}"
+                info.mdl_info[DTYPE_VIDEO].download_url = info.url[:sq_idx] + "&sq="
 
             if not info.mdl_info[DTYPE_AUDIO].download_url:
                 get_gvideo_url(info, DTYPE_AUDIO)
@@ -1568,7 +1942,7 @@ def try_move(src_file, dst_file):
     """
     try:
         if os.path.exists(src_file):
-            loginfo("Moving file {0} to {1}".format(src_file, dst_file))
+            loginfo("Moving file {0} to {1}", src_file, dst_file)
             os.replace(src_file, dst_file)
     except Exception as err:
         logwarn("Error moving file: {0}".format(err))
@@ -1580,16 +1954,29 @@ def try_delete(fname):
 
     :param fname:
     """
+    # Just try the delete, checking if the file exists first is an extra stat
+    # for every file and doesn't save us from handling it not existing anyway
     try:
-        if os.path.exists(fname):
-            loginfo("Deleting file {0}".format(fname))
-            os.remove(fname)
+        os.remove(fname)
+        loginfo("Deleted file {0}", fname)
     except FileNotFoundError:
         pass
     except Exception as err:
         logwarn("Error deleting file: {0}".format(err))
 
 
+def log_future_errors(futures):
+    """
+    Log any exceptions raised by finished futures
+    Pool threads don't print uncaught exceptions like normal threads do
+
+    :param futures:
+    """
+    for fut in futures:
+        if fut.done() and fut.exception():
+            logerror("Download thread failed: {0!r}".format(fut.exception()))
+
+
 def cleanup_files(files):
     for f in files:
         try_delete(f)
@@ -1908,14 +2295,12 @@ def main():
         cjar = http.cookiejar.MozillaCookieJar(cfile)
         try:
             cjar.load()
-            loginfo("Loaded cookie file {0}".format(cfile))
+            loginfo("Loaded cookie file {0}", cfile)
         except Exception as err:
             logerror("Failed to load cookies file: {0}".format(err))
             sys.exit(1)
 
-        cproc = urllib.request.HTTPCookieProcessor(cjar)
-        opener = urllib.request.build_opener(cproc)
-        urllib.request.install_opener(opener)
+        HTTP_CLIENT.cookie_jar = cjar
 
     if not info.gvideo_ddl and not get_video_info(info):
         sys.exit(1)
@@ -1940,7 +2325,8 @@ def main():
         sys.exit(1)
 
     # Output format included a directory structure. Create it if it doesn't exist
-    if fdir:
+    # Check first, makedirs always attempts the mkdir even when the directory is there
+    if fdir and not os.path.isdir(fdir):
         try:
             os.makedirs(fdir, exist_ok=True)
         except Exception as err:
@@ -1963,64 +2349,78 @@ def main():
     thmbnl_file = os.path.join(tmpdir.name, thmbnl_file_name)
     desc_file = os.path.join(tmpdir.name, desc_file_name)
 
-    progress_queue = queue.Queue()
+    progress_queue = queue.SimpleQueue()
     total_bytes = 0
-    threads = []
+    futures = []
     frags = {
         DTYPE_AUDIO: 0,
         DTYPE_VIDEO: 0
     }
 
+    if write_desc and info.metadata.meta["comment"]:
+        with open(desc_file, "w", encoding="utf-8") as f:
+            f.write(info.metadata.meta["comment"])
+
+    # One pool for both streams. Each needs a thread for itself plus its fragment downloaders,
+    # and one more for the thumbnail
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * (info.thread_count + 1) + 1)
+
     # Grab the thumbnail for the livestream for embedding later
+    # No need to hold up the downloads for it, it is only needed once they finish
+    thumb_future = None
     if (thumbnail or write_thumb) and info.thumbnail:
-        downloaded = download_thumbnail(info.thumbnail, thmbnl_file)
-
-        # Failed to download but file itself got created. Remove it
-        if not downloaded and os.path.exists(thmbnl_file):
-            try_delete(thmbnl_file)
-            thumbnail = False
-            write_thumb = False
+        thumb_future = pool.submit(download_thumbnail, info.thumbnail, thmbnl_file)
     else:
         thumbnail = False
         write_thumb = False
 
-    if write_desc and info.metadata.meta["comment"]:
-        with open(desc_file, "w", encoding="utf-8") as f:
-            f.write(info.metadata.meta["comment"])
-
-    loginfo("Starting download to {0}".format(afile))
-    athread = threading.Thread(target=download_stream,
-                               args=(DTYPE_AUDIO, afile, progress_queue, info, frag_files))
-
-    threads.append(athread)
-    athread.start()
+    loginfo("Starting download to {0}", afile)
+    futures.append(pool.submit(download_stream, DTYPE_AUDIO, afile, progress_queue, info, frag_files, pool))
 
     if info.mdl_info[DTYPE_VIDEO].download_url:
-        loginfo("Starting download to {0}".format(vfile))
-        vthread = threading.Thread(target=download_stream,
-                                   args=(DTYPE_VIDEO, vfile, progress_queue, info, frag_files))
+        loginfo("Starting download to {0}", vfile)
+        futures.append(pool.submit(download_stream, DTYPE_VIDEO, vfile, progress_queue, info, frag_files, pool))
 
-        threads.append(vthread)
-        vthread.start()
+    # Each stream puts a None on the queue when it finishes, after its last progress update.
+    # Counting those tells us when everything is done without polling the futures
+    for fut in futures:
+        fut.add_done_callback(lambda _: progress_queue.put(None))
 
     # Print progress to stdout
     # Included info is video and audio fragments downloaded, and total data downloaded
     max_seqs = -1
+    remaining = len(futures)
     while True:
-        alive = False
-
-        for t in threads:
-            if t.is_alive():
-                alive = True
-                break
+        alive = remaining > 0
 
         try:
-            progress = progress_queue.get(timeout=1)
-            total_bytes += progress.bytes
-            frags[progress.data_type] += 1
+            # Once the downloads are finished, only take what is left in the queue
+            if alive:
+                progress = progress_queue.get(timeout=1)
+            else:
+                progress = progress_queue.get_nowait()
+
+            # Take everything that is waiting and only print the status once for all of it
+            updated = False
+            while True:
+                if progress is None:
+                    remaining -= 1
+                else:
+                    total_bytes += progress.bytes
+                    frags[progress.data_type] += progress.frags
 
-            if progress.max_seq > max_seqs:
-                max_seqs = progress.max_seq
+                    if progress.max_seq > max_seqs:
+                        max_seqs = progress.max_seq
+
+                    updated = True
+
+                try:
+                    progress = progress_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if not updated:
+                continue
 
             status = "\rVideo fragments: {0}; Audio fragments: {1}; ".format(frags[DTYPE_VIDEO], frags[DTYPE_AUDIO])
             if debug:
@@ -2032,12 +2432,12 @@ def main():
             pass
         except KeyboardInterrupt:
             # Attempt to shutdown gracefully by stopping the download threads
-            with info.lock:
-                info.stopping = True
+            info.stop_event.set()
             print("\nKeyboard Interrupt, stopping download...")
 
-            for t in threads:
-                t.join()
+            concurrent.futures.wait(futures)
+            if thumb_future:
+                concurrent.futures.wait([thumb_future])
 
             print()
             merge = False
@@ -2048,6 +2448,7 @@ def main():
                 merge = True
 
             if merge:
+                remaining = 0
                 alive = False
             else:
                 save_files = False
@@ -2065,9 +2466,17 @@ def main():
                 tmpdir.cleanup()
                 sys.exit(2)
 
-        if not alive:
+        if not alive and progress_queue.empty():
             break
 
+    pool.shutdown()
+    log_future_errors(futures)
+
+    # Failed to download the thumbnail, but the file itself may have been created. Remove it
+    if thumb_future and not thumb_future.result():
+        try_delete(thmbnl_file)
+        thumbnail = False
+        write_thumb = False
     print("\nDownload finished")
     aonly = info.quality == VIDEO_LABEL_ITAGS["audio_only"]
 
@@ -2082,23 +2491,27 @@ def main():
     new_desc = os.path.join(fdir, desc_file_name)
 
     try_move(afile, new_afile)
-    try_move(vfile, new_vfile)
     try_move(thmbnl_file, new_thmbnail)
     try_move(desc_file, new_desc)
-
     files.append(new_afile)
-    files.append(new_vfile)
+
+    # There is no video file to move or clean up for audio only downloads
+    if not aonly:
+        try_move(vfile, new_vfile)
+        files.append(new_vfile)
+
     if not write_thumb:
         files.append(new_thmbnail)
 
     tmpdir.cleanup()
 
     retcode = 0
-    mfile = ""
+    mfile_name = os.path.join(fdir, fname)
     ffmpeg_args = [
         "ffmpeg",
         "-hide_banner",
         "-loglevel", "warning",
+        *FFMPEG_INPUT_ARGS,
         "-i", new_afile
     ]
 
@@ -2107,12 +2520,13 @@ def main():
 
     if aonly:
         print("Correcting audio container")
-        mfile = os.path.join(fdir, "{0}.m4a".format(fname))
+        mfile_ext = "m4a"
     else:
         print("Muxing files")
-        mfile = os.path.join(fdir, "{0}.mp4".format(fname))
+        mfile_ext = "mp4"
 
         ffmpeg_args.extend([
+            *FFMPEG_INPUT_ARGS,
             "-i", new_vfile,
             "-movflags", "faststart"
         ])
@@ -2136,7 +2550,7 @@ def main():
                     "{0}={1}".format(k.upper(), v)
                 ])
 
-    mfile_name, mfile_ext = mfile.rsplit('.', 1)
+    mfile = "{0}.{1}".format(mfile_name, mfile_ext)
     mfile_ctr = 0
     while os.path.exists(mfile):
         mfile_ctr += 1